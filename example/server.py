@@ -1,13 +1,40 @@
+import logging
 import os
-from flask import Flask, Blueprint, current_app, redirect, request, url_for
+import queue
+from flask import (
+    Flask,
+    Blueprint,
+    Response,
+    current_app,
+    redirect,
+    request,
+    url_for,
+)
 import sqlite3
+import stat
+import threading
 import time
 from typing import Optional
+from contextlib import contextmanager
 import json
 
 import click
 import pathlib
-from stitch import UserTokenStoreInterface, TokenDetails, Stitch
+from flask_cors import CORS
+from werkzeug.http import generate_etag
+from stitch import (
+    UserTokenStoreInterface,
+    TokenDetails,
+    Stitch,
+    TOKEN_EXPIRY_MARGIN_SECONDS,
+)
+
+# set up logging, once, at import rather than on every init_app
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s]: %(message)s",
+    datefmt="%H:%M:%S",
+)
 
 # ============================ HANDLERS =======================================
 # =============================================================================
@@ -20,22 +47,31 @@ def retrieve_bank_accounts():
     user_id = 1  # for demo, TODO, use sessions to retrieve user id
     stitch = current_app.config["stitch"]
 
-    if stitch.should_authorize(user_id):
-        stitch_authorization_url = stitch.initiate_authorization(user_id)
-        return redirect(stitch_authorization_url)
+    td_or_url = stitch.get_or_authorize(user_id)
+    if isinstance(td_or_url, str):
+        return redirect(td_or_url)
 
-    bank_accounts = stitch.get_bank_accounts(user_id)
+    bank_accounts = stitch.get_bank_accounts(user_id, td_or_url)
     return bank_accounts
 
 
-@user_bp.route("/")
-def index():
-    html = """
+_INDEX_HTML = """
     <form>
       <button formaction="/bank_accounts">List bank accounts</button>
     </form>
     """
-    return html
+_INDEX_ETAG = generate_etag(_INDEX_HTML.encode("utf-8"))
+
+
+@user_bp.route("/")
+def index():
+    # a fresh response is built per request since make_conditional modifies it
+    # in place (e.g. sets the 304 status), only the body and etag are reused
+    resp = Response(_INDEX_HTML, mimetype="text/html")
+    resp.set_etag(_INDEX_ETAG)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 3600
+    return resp.make_conditional(request)
 
 
 @user_bp.route("/return", methods=("GET",))
@@ -54,8 +90,29 @@ def handle_return_from_stitch_sso():
 # =============================================================================
 # ============================ DATABASE ACCESS ================================
 
-
-def init_db(db_file):
+_SELECT_TOKEN_SQL = """
+select id_token, access_token, expires_at, token_type, refresh_token, scope
+from user_stitch_tokens where user_id = ?
+"""
+
+_UPSERT_TOKEN_SQL = """
+insert into
+user_stitch_tokens(user_id, id_token, access_token, expires_at, token_type, refresh_token, scope)
+values (?,?,?,?,?,?,?)
+on conflict(user_id)
+do update set
+    id_token=excluded.id_token,
+    access_token=excluded.access_token,
+    expires_at=excluded.expires_at,
+    token_type=excluded.token_type,
+    refresh_token=excluded.refresh_token,
+    scope=excluded.scope
+"""
+
+_DELETE_EXPIRED_SQL = "delete from user_stitch_tokens where expires_at <= ?"
+
+
+def init_and_seed(db_file):
     # schema = []
     # schema.append(
     schema_sql = """
@@ -67,69 +124,113 @@ def init_db(db_file):
     create table if not exists user_stitch_tokens(
         user_id integer primary key,
 
-        id_token blob not null,
-        access_token blob not null,
+        id_token text not null,
+        access_token text not null,
         expires_at int not null,
-        token_type str not null,
-        refresh_token blob not null,
+        token_type text not null,
+        refresh_token text not null,
         scope text not null,
 
         foreign key(user_id) references users(id)
     );
     """
-    conn = None
-    try:
-        conn = sqlite3.connect(db_file)
-        c = conn.cursor()
-        c.executescript(schema_sql)
-        conn.commit()
-    finally:
-        if conn:
-            conn.close()
-
-
-def seed_db(db_file):
     test_user = "test-user"
 
     conn = None
     try:
-        conn = sqlite3.connect(db_file)
-        c = conn.cursor()
-        c.execute("insert into users(username) values (?)", (test_user,))
-        conn.commit()
-    except sqlite3.IntegrityError as e:
-        pass
+        conn = sqlite3.connect(db_file, isolation_level=None)
+        # journal mode is persisted in the db file so connections opened
+        # later on by the token store start off in WAL mode
+        conn.execute("pragma journal_mode=WAL")
+        conn.execute("pragma synchronous=NORMAL")
+        # executescript commits any pending transaction before running, hence
+        # the begin is part of the script itself
+        conn.executescript(f"begin; {schema_sql}")
+        conn.execute("insert or ignore into users(username) values (?)", (test_user,))
+        conn.execute("commit")
     finally:
         if conn:
             conn.close()
 
 
 class SqliteUserTokenStore(UserTokenStoreInterface):
-    def __init__(self, db_file):
+    def __init__(self, db_file, pool_size=8):
         self._db_file = db_file
-
-    def get_token_details(self, user_id: int) -> Optional[TokenDetails]:
-        conn = None
-        token_details = None
+        # idle connections shared by all request threads. The dev server runs
+        # each request on a new thread, so connections are pooled here rather
+        # than kept per thread
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        # short-lived in-process cache of token details keyed by user_id,
+        # {user_id: (TokenDetails, cache_until)}
+        self._cache = dict()
+        # {user_id: generation}, bumped on every set so that a lookup racing
+        # with a set does not cache the row it read before the set
+        self._cache_generations = dict()
+        self._cache_lock = threading.Lock()
+        self._cache_ttl = 60
+
+    def _connect(self) -> sqlite3.Connection:
+        # journal_mode=WAL is persisted in the db file by init_and_seed, the
+        # remaining pragmas are per connection
+        conn = sqlite3.connect(
+            self._db_file, check_same_thread=False, isolation_level=None
+        )
+        conn.execute("pragma synchronous=NORMAL")
+        conn.execute("pragma foreign_keys=1")
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def _conn(self):
+        """
+        reserve an idle connection from the pool, or open a new one if there
+        is none, and return it to the pool afterwards. Connections beyond the
+        pool's size are closed rather than kept
+        """
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
         try:
-            conn = sqlite3.connect(self._db_file)
-            c = conn.cursor()
-            res = c.execute(
-                """
-            select id_token, access_token, expires_at, token_type, refresh_token, scope
-            from user_stitch_tokens where user_id = ?
-            """,
-                (user_id,),
-            ).fetchone()
-            if res is not None:
-                token_details = TokenDetails(*res)
+            yield conn
         finally:
-            if conn:
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
                 conn.close()
+
+    def get_token_details(self, user_id: int) -> Optional[TokenDetails]:
+        now = time.time()
+        with self._cache_lock:
+            cached = self._cache.get(user_id)
+            generation = self._cache_generations.get(user_id, 0)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        token_details = None
+        with self._conn() as conn:
+            res = conn.execute(_SELECT_TOKEN_SQL, (user_id,)).fetchone()
+        if res is not None:
+            token_details = TokenDetails(
+                id_token=res["id_token"],
+                access_token=res["access_token"],
+                expires_at_seconds_from_epoch=res["expires_at"],
+                token_type=res["token_type"],
+                refresh_token=res["refresh_token"],
+                scope=res["scope"],
+            )
+            cache_until = min(
+                token_details.expires_at_seconds_from_epoch
+                - TOKEN_EXPIRY_MARGIN_SECONDS,
+                now + self._cache_ttl,
+            )
+            if cache_until > now:
+                with self._cache_lock:
+                    if self._cache_generations.get(user_id, 0) == generation:
+                        self._cache[user_id] = (token_details, cache_until)
         return token_details
 
     def set_token_details(self, user_id: int, td: TokenDetails):
-        conn = None
         td_as_tuple = (
             td.id_token,
             td.access_token,
@@ -138,46 +239,19 @@ class SqliteUserTokenStore(UserTokenStoreInterface):
             td.refresh_token,
             td.scope,
         )
-        try:
-            conn = sqlite3.connect(self._db_file)
-            c = conn.cursor()
-            c.execute("pragma foreign_keys=1")
-            c.execute(
-                """
-            insert into
-            user_stitch_tokens(user_id, id_token, access_token, expires_at, token_type, refresh_token, scope)
-            values (?,?,?,?,?,?,?)
-            on conflict(user_id)
-            do update set
-                id_token=excluded.id_token,
-                access_token=excluded.access_token,
-                expires_at=excluded.expires_at,
-                token_type=excluded.token_type,
-                refresh_token=excluded.refresh_token,
-                scope=excluded.scope
-            """,
-                (user_id, *td_as_tuple),
+        with self._conn() as conn:
+            conn.execute(_UPSERT_TOKEN_SQL, (user_id, *td_as_tuple))
+        with self._cache_lock:
+            self._cache.pop(user_id, None)
+            self._cache_generations[user_id] = (
+                self._cache_generations.get(user_id, 0) + 1
             )
-            conn.commit()
-        finally:
-            if conn:
-                conn.close()
         return
 
     def delete_expired_tokens(self):
-        conn = None
-        try:
-            conn = sqlite3.connect(self._db_file)
-            c = conn.cursor()
-            now = time.time()
-            c.execute(
-                "delete from user_stitch_tokens where expires_at <= ?",
-                (now,),
-            )
-            conn.commit()
-        finally:
-            if conn:
-                conn.close()
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute(_DELETE_EXPIRED_SQL, (now,))
 
 
 # =============================================================================
@@ -188,20 +262,10 @@ def init_app(stitch_config, db_config):
     # create app
     app = Flask(__name__)
 
-    # set up logging
-    import logging
-
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s [%(levelname)s]: %(message)s",
-        datefmt="%H:%M:%S",
-    )
-
     # set up database
 
     db_file = db_config["db_file"]
-    init_db(db_file)
-    seed_db(db_file)
+    init_and_seed(db_file)
     app.config["db_file"] = db_file
 
     # set up authz for stitch api
@@ -220,8 +284,6 @@ def init_app(stitch_config, db_config):
 
     # add CORS headers for dev
     if app.config["DEBUG"] == True:
-        from flask_cors import CORS
-
         CORS(app)
         app.logger.info("add CORS headers. For development env only")
     else:
@@ -245,9 +307,11 @@ def _validate_is_nonempty(ctx, param, val):
 
 def _validate_file_path(ctx, param, val):
     _validate_is_nonempty(ctx, param, val)
-    if not os.path.exists(val):
-        raise click.BadParameter(f"{val} does not exist")
-    if not os.path.isfile(val):
+    try:
+        st = os.stat(val)
+    except OSError as e:
+        raise click.BadParameter(f"{val}: {e.strerror}") from e
+    if not stat.S_ISREG(st.st_mode):
         raise click.BadParameter(f"{val} is not a file")
     return val
 
@@ -269,7 +333,8 @@ def _validate_file_path(ctx, param, val):
 def run_server(stitch_client_id, stitch_cert_path):
     # stitch config
     stitch_client_secret = None
-    with open(stitch_cert_path, "r") as f:
+    # PEM is ASCII and PyJWT accepts the key as bytes, so skip decoding it
+    with open(stitch_cert_path, "rb", buffering=65536) as f:
         stitch_client_secret = f.read()
     stitch_config = {
         "client_id": stitch_client_id,
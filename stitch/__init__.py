@@ -3,18 +3,64 @@ import datetime as dt
 import time
 import json
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from dataclasses import dataclass
 from typing import Optional, Any
-import re
 import base64
 import secrets
 import urllib.parse
 from hashlib import sha256
 import uuid
+import threading
 
 # external dependencies
 import jwt
+from jwt.algorithms import RSAAlgorithm
 import requests
+from requests.adapters import HTTPAdapter, Retry
+
+# orjson is optional, fall back to the stdlib json module if not installed
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+
+# the request body for listing a user's bank accounts never changes, so it is
+# serialized once
+_LIST_BANK_ACCOUNTS_BODY = _json_dumps(
+    {
+        "query": """query ListBankAccounts
+        {
+          user {
+            bankAccounts {
+              name
+              currency
+              branchCode
+              bankId
+              accountType
+              accountNumber
+              supportsPaymentInitiation
+            }
+          }
+        }
+        """,
+        "variables": None,
+    }
+)
+
+# tokens this close to expiring, in seconds, are treated as already expired to
+# allow for clock skew between us and stitch
+TOKEN_EXPIRY_MARGIN_SECONDS = 30
+
+# (connect, read) timeouts in seconds for requests to stitch
+_HTTP_TIMEOUT = (3.05, 10)
 
 
 @dataclass(repr=False, frozen=True)
@@ -28,7 +74,7 @@ class TokenDetails:
 
     @staticmethod
     def from_json(s: str | bytes | bytearray):
-        as_dict = json.loads(s)
+        as_dict = _json_loads(s)
         t = TokenDetails(
             id_token=as_dict["id_token"],
             access_token=as_dict["access_token"],
@@ -53,7 +99,7 @@ class TokenDetails:
         expires_in = int(self.expires_at_seconds_from_epoch - time.time())
         if expires_in < 0:  # already expired
             expires_in = 0
-        return json.dumps(
+        return _json_dumps(
             {
                 "id_token": self.id_token,
                 "access_token": self.access_token,
@@ -62,11 +108,11 @@ class TokenDetails:
                 "refresh_token": self.refresh_token,
                 "scope": self.scope,
             }
-        )
+        ).decode("utf-8")
 
     def is_expired(self) -> bool:
         now = time.time()
-        return self.expires_at_seconds_from_epoch <= now
+        return now >= self.expires_at_seconds_from_epoch - TOKEN_EXPIRY_MARGIN_SECONDS
 
     def __str__(self) -> str:
         return "TokenDetails(id_token={}..., access_token={}..., expires_at={}, token_type={}, refresh_token={}..., scope={})".format(
@@ -133,30 +179,54 @@ class UserAuthRequestsStoreInterface(ABC):
 
 
 class InMemoryUserAuthRequestsStore(UserAuthRequestsStoreInterface):
-    def __init__(self):
-        self._store = dict()
+    """
+    requests are evicted once they are older than ttl seconds (abandoned
+    authorizations) or, oldest first, once there are more than maxsize of them
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 600):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        # state -> (request, expires_at), kept in order of expiry. expires_at
+        # is on the monotonic clock so that order holds if the wall clock steps
+        self._store = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict_expired(self, now: float):
+        while self._store:
+            _, (_, expires_at) = next(iter(self._store.items()))
+            if expires_at > now:
+                break
+            self._store.popitem(last=False)
 
     def get_request(self, state: str) -> UserAuthRequest:
-        return self._store.get(state)
+        with self._lock:
+            self._evict_expired(time.monotonic())
+            entry = self._store.get(state)
+        return entry[0] if entry is not None else None
 
     def set_request(self, req: UserAuthRequest):
-        self._store[req.stitch_state] = req
+        now = time.monotonic()
+        with self._lock:
+            self._evict_expired(now)
+            self._store[req.stitch_state] = (req, now + self._ttl)
+            self._store.move_to_end(req.stitch_state)
+            while len(self._store) > self._maxsize:
+                self._store.popitem(last=False)
 
     def pop_request(self, state: str) -> UserAuthRequest:
-        req = self._store.get(state)
-        if req is not None:
-            del self._store[state]
-        return req
+        with self._lock:
+            self._evict_expired(time.monotonic())
+            entry = self._store.pop(state, None)
+        return entry[0] if entry is not None else None
 
     def delete_request(self, state: str) -> bool:
-        req = self._store.get(state)
-        if req is not None:
-            del self._store[state]
-            return True
-        return False
+        with self._lock:
+            self._evict_expired(time.monotonic())
+            return self._store.pop(state, None) is not None
 
 
-@dataclass
+@dataclass(slots=True)
 class BankAccount:
     name: str
     currency: str
@@ -167,19 +237,24 @@ class BankAccount:
     supports_payment_initiation: bool
 
     @staticmethod
-    def _from_api_res(**r):
-        return BankAccount(
-            r["name"],
-            r["currency"],
-            int(r["branchCode"]),
-            r["bankId"],
-            r["accountType"],
-            r["accountNumber"],
-            r["supportsPaymentInitiation"],
-        )
+    def _list_from_api_res(entries: list[dict]) -> list["BankAccount"]:
+        return [
+            BankAccount(
+                r["name"],
+                r["currency"],
+                int(r["branchCode"]),
+                r["bankId"],
+                r["accountType"],
+                r["accountNumber"],
+                r["supportsPaymentInitiation"],
+            )
+            for r in entries
+        ]
 
 
 class Stitch:
+    _GRAPHQL_HEADERS = {"Content-Type": "application/json"}
+
     def __init__(
         self,
         client_id,
@@ -191,6 +266,13 @@ class Stitch:
     ):
         self.client_id = client_id
         self.client_secret = client_secret
+        # parse a PEM once rather than on every jwt signed with it, already
+        # loaded key objects are used as is
+        self._signing_key = client_secret
+        if isinstance(client_secret, (str, bytes)):
+            self._signing_key = RSAAlgorithm(RSAAlgorithm.SHA256).prepare_key(
+                client_secret
+            )
         self.redirect_uri = redirect_uri
 
         # token store
@@ -212,12 +294,39 @@ class Stitch:
 
         self.logger = logger
 
+        # pooled session so that subsequent calls to stitch reuse a keep-alive
+        # connection rather than redoing the TCP and TLS handshakes
+        self._http = requests.Session()
+        self._http.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=10,
+                pool_maxsize=50,
+                # every call to stitch is a POST and the authorization code
+                # exchange is single use, so only failures to connect, where
+                # nothing was sent, are retried
+                max_retries=Retry(connect=3, read=0, status=0, backoff_factor=0.2),
+            ),
+        )
+
     def should_authorize(self, user) -> bool:
         td = self.token_store.get_token_details(user)
         if td is None:
             return True
         return False
 
+    def get_or_authorize(self, user) -> TokenDetails | str:
+        """
+        returns the user's token details if present, otherwise initiates
+        authorization and returns the URL the user should be redirected to.
+        Lets callers check for authorization and retrieve the token with a
+        single token store lookup
+        """
+        td = self._get_token(user)
+        if td is None:
+            return self.initiate_authorization(user)
+        return td
+
     def initiate_authorization(self, user) -> str:
         state = _gen_random_base64_str()
         nonce = _gen_random_base64_str()
@@ -258,8 +367,8 @@ class Stitch:
             "code_challenge": code_challenge,
             "code_challenge_method": "S256",
         }
-        encoded_params = "&".join(
-            f"{k}={urllib.parse.quote(v)}" for k, v in params.items()
+        encoded_params = urllib.parse.urlencode(
+            params, safe="/", quote_via=urllib.parse.quote
         )
         authz_code_endpoint = (
             f"https://secure.stitch.money/connect/authorize?{encoded_params}"
@@ -282,7 +391,9 @@ class Stitch:
             "client_assertion": self._encode_client_jwt(),
         }
         retrieve_user_token_endpoint = "https://secure.stitch.money/connect/token"
-        req = requests.post(retrieve_user_token_endpoint, params)
+        req = self._http.post(
+            retrieve_user_token_endpoint, params, timeout=_HTTP_TIMEOUT
+        )
         td = TokenDetails.from_json(req.content)
         self.token_store.set_token_details(user, td)
 
@@ -298,7 +409,7 @@ class Stitch:
             "nbf": now,
             "exp": one_hour_from_now,
         }
-        encoded_jwt = jwt.encode(payload, self.client_secret, algorithm="RS256")
+        encoded_jwt = jwt.encode(payload, self._signing_key, algorithm="RS256")
         return encoded_jwt
 
     def _refresh_token(self, user, refresh_token: str) -> TokenDetails:
@@ -310,7 +421,7 @@ class Stitch:
             "client_assertion": self._encode_client_jwt(),
         }
         refresh_user_tokens_url = "https://secure.stitch.money/connect/token"
-        req = requests.post(refresh_user_tokens_url, params)
+        req = self._http.post(refresh_user_tokens_url, params, timeout=_HTTP_TIMEOUT)
         td = TokenDetails.from_json(req.content)
         self.token_store.set_token_details(user, td)
         return td
@@ -326,47 +437,27 @@ class Stitch:
 
         return td
 
-    def get_bank_accounts(self, user):
-        td = self._get_token(user)
+    def _graphql_headers_for(self, td: TokenDetails) -> dict:
+        return {**self._GRAPHQL_HEADERS, "Authorization": f"Bearer {td.access_token}"}
+
+    def get_bank_accounts(self, user, td: Optional[TokenDetails] = None):
+        if td is None:
+            td = self._get_token(user)
         if td is None:
             raise Exception("User not authorized or error retrieving token")
 
         stitch_url = "https://api.stitch.money/graphql"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {td.access_token}",
-        }
-        query = """query ListBankAccounts
-        {
-          user {
-            bankAccounts {
-              name
-              currency
-              branchCode
-              bankId
-              accountType
-              accountNumber
-              supportsPaymentInitiation
-            }
-          }
-        }
-        """
-        graphql_query = json.dumps(
-            {
-                "query": query,
-                "variables": None,
-            }
+        req = self._http.post(
+            stitch_url,
+            data=_LIST_BANK_ACCOUNTS_BODY,
+            headers=self._graphql_headers_for(td),
+            timeout=_HTTP_TIMEOUT,
         )
-        req = requests.post(stitch_url, data=graphql_query, headers=headers)
-        res = req.json()
+        res = _json_loads(req.content)
         errors = res.get("errors")
         if req.status_code == 200 and errors is None:
             bank_accounts_raw = res["data"]["user"]["bankAccounts"]
-            bank_accounts = []
-            for entry in bank_accounts_raw:
-                ba = BankAccount._from_api_res(**entry)
-                bank_accounts.append(ba)
-            return bank_accounts
+            return BankAccount._list_from_api_res(bank_accounts_raw)
 
         else:
             err_message = "Error retrieving user's stitch data"
@@ -380,15 +471,6 @@ class Stitch:
             raise Exception(err_message)
 
 
-def _encode_bytes_to_base64_str(bs) -> str:
-    res = base64.b64encode(bs)
-    res = re.sub(b"=", b"", res)
-    res = re.sub(b"\\+", b"-", res)
-    res = re.sub(b"\\/", b"_", res)
-    as_str = res.decode("ascii")
-    return as_str
-
-
 def _gen_code_challenge_and_verifier() -> tuple[str, str]:
     """
     generates a random code
@@ -398,14 +480,12 @@ def _gen_code_challenge_and_verifier() -> tuple[str, str]:
 
     the unhashed value (verifier) is sent with the user access token request
     """
-    random_bytes = secrets.token_bytes(32)
-
-    verifier = _encode_bytes_to_base64_str(random_bytes)
-
-    challenge_bs = sha256(verifier.encode("utf-8")).digest()
-    challenge = _encode_bytes_to_base64_str(challenge_bs)
-    return challenge, verifier
+    # kept as Base64URL bytes throughout so the verifier is hashed as is
+    # without a round trip through str
+    verifier = base64.urlsafe_b64encode(secrets.token_bytes(32)).rstrip(b"=")
+    challenge = base64.urlsafe_b64encode(sha256(verifier).digest()).rstrip(b"=")
+    return challenge.decode("ascii"), verifier.decode("ascii")
 
 
 def _gen_random_base64_str() -> str:
-    return _encode_bytes_to_base64_str(secrets.token_bytes(32))
+    return secrets.token_urlsafe(32)